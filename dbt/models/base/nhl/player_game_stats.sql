@@ -4,7 +4,8 @@ select
         player_person_fullName full_name,
         player_person_currentTeam_name game_team_name,
         player_stats_skaterStats_assists stats_assists,
-        player_stats_skaterStats_goals stats_goals
+        player_stats_skaterStats_goals stats_goals,
+        game_id
   from {{ source('nhl', 'game_stats') }}
 
 
@@ -9,17 +9,29 @@ automomously.  So feel free to add anywhere (not hinted, this is where we see yo
     * messaging for monitoring or troubleshooting
     * anything else you think is necessary to have for restful nights
 """
+import csv
+import gzip
+import io
+import json
 import logging
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
 from dataclasses import dataclass
 import boto3
 import requests
-import pandas as pd
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from botocore.config import Config
 from dateutil.parser import parse as dateparse
 import os
 import argparse
 
+try:
+    import orjson as json_lib
+except ImportError:  # orjson is optional, stdlib json decodes the same payloads just slower
+    import json as json_lib
+
 logging.basicConfig(level=logging.INFO)
 LOG = logging.getLogger(__name__)
 
@@ -27,9 +39,18 @@ LOG = logging.getLogger(__name__)
 class NHLApi:
     SCHEMA_HOST = "https://statsapi.web.nhl.com/"
     VERSION_PREFIX = "api/v1"
+    # (connect, read) seconds
+    TIMEOUT = (3.05, 30)
+    RETRIES = Retry(total=5, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504])
 
     def __init__(self, base=None):
         self.base = base if base else f'{self.SCHEMA_HOST}/{self.VERSION_PREFIX}'
+        # one session shared by all crawler threads so connections get pooled,
+        # transient failures are retried with backoff by the adapter
+        self._session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=self.RETRIES)
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
 
     def schedule(self, start_date: datetime, end_date: datetime) -> dict:
         """
@@ -88,19 +109,11 @@ class NHLApi:
         return self._get(url)
 
     def _get(self, url, params=None):
-        try:
-            response = requests.get(url, params=params)
-            response.raise_for_status()
-        except requests.exceptions.ConnectionError:
-            logging.exception("NETWORK PROBLEM")
-            raise SystemExit(1)
-        except requests.exceptions.HTTPError:
-            logging.exception("UNSUCCESSFUL STATUS CODE")
-            raise SystemExit(1)
-        except requests.exceptions.Timeout:
-            logging.exception("REQUEST TIMED OUT")
-            raise SystemExit(1)
-        return response.json()
+        # errors (RetryError once the adapter gives up, ConnectionError, Timeout, HTTPError) carry the url and
+        # propagate as is, main() logs them once
+        response = self._session.get(url, params=params, timeout=self.TIMEOUT)
+        response.raise_for_status()
+        return json_lib.loads(response.content)
 
     def _url(self, path):
         return f'{self.base}/{path}'
@@ -108,13 +121,14 @@ class NHLApi:
 
 @dataclass
 class StorageKey:
-    def __init__(self, game_id, game_date):
-        self._gameId = game_id
-        self._gameDate = game_date.strftime("%Y%m%d")
+    def __init__(self, game_date: str):
+        """ game_date is already formatted as yyyymmdd """
+        self._gameDate = game_date
+        self._key = f'{self._gameDate}/games.csv.gz'
 
     def key(self):
         """ renders the s3 key for the given set of properties """
-        return f'{self._gameDate}_{self._gameId}.csv'
+        return self._key
 
 
 class Storage:
@@ -122,64 +136,167 @@ class Storage:
         self._s3_client = s3_client
         self.bucket = dest_bucket
 
-    def store_game(self, key: StorageKey, game_data) -> bool:
-        self._s3_client.put_object(Bucket=self.bucket, Key=key.key(), Body=game_data)
+    def store_games(self, key: StorageKey, games_data: str) -> bool:
+        """
+        csv text compresses well, so it is stored as a .gz object. No Content-Encoding is set, otherwise http
+        clients would transparently decompress a file named .gz on download
+        """
+        body = gzip.compress(games_data.encode('utf-8'))
+        self._s3_client.put_object(Bucket=self.bucket, Key=key.key(), Body=body, ContentType='application/gzip')
         return True
 
 
+class Manifest:
+    """
+    Local record of the game ids already written for each date, so reruns can skip finished dates without
+    issuing a HeadObject per key. A date is rewritten whenever its schedule lists a game not recorded here.
+    Entries are kept per bucket, and the file has to be removed whenever the bucket's contents are wiped.
+    """
+
+    def __init__(self, path, bucket):
+        self.path = path
+        self._buckets = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self._buckets = json.load(f)
+        self._written = self._buckets.setdefault(bucket, {})
+
+    def is_written(self, game_date: str, game_ids) -> bool:
+        return game_date in self._written and set(game_ids) <= set(self._written[game_date])
+
+    def mark_written(self, game_date: str, game_ids) -> None:
+        self._written[game_date] = sorted(game_ids)
+        # write then rename so a crash mid-save can't leave a truncated manifest behind
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(self._buckets, f)
+        os.replace(tmp_path, self.path)
+
+
 class Crawler:
     """
-    This class is responsible for writing CSV files (partitioned by date and game id) with player stats to an s3 bucket.
-    The crawl method loops over games in a certain date range, grabs all the player stats by looping through
-    several layers of a nested dict, then writes the files to s3 with their s3 key being generated by the StorageKey
-    class and the storage of the files being handled by the Storage class.
+    This class is responsible for writing CSV files (one per date, covering every game on it) with player stats to
+    an s3 bucket. The crawl method loops over games in a certain date range, grabs all the player stats by looping
+    through several layers of a nested dict, then writes the files to s3 with their s3 key being generated by the
+    StorageKey class and the storage of the files being handled by the Storage class.
     """
+    BOXSCORE_WORKERS = 16
+    UPLOAD_WORKERS = 32
+    DATES_IN_FLIGHT = 4
+    PLAYER_COLUMNS = ["player_person_id",
+                      "player_person_currentTeam_name",
+                      "player_person_fullName",
+                      "player_stats_skaterStats_assists",
+                      "player_stats_skaterStats_goals",
+                      "side",
+                      "game_id"
+                      ]
 
-    def __init__(self, api: NHLApi, storage: Storage):
+    def __init__(self, api: NHLApi, storage: Storage, manifest: Manifest = None):
         self.api = api
         self.storage = storage
+        self.manifest = manifest
 
     def crawl(self, start_date: datetime, end_date: datetime) -> None:
-        logging.info(f"STARTING CRAWL")
+        """
+        Fetching, rendering and uploading are pipelined: boxscores for upcoming dates are fetched while earlier
+        dates are rendered and uploaded. At most DATES_IN_FLIGHT dates of boxscores and UPLOAD_WORKERS rendered
+        files are held in memory, finished uploads are logged (and recorded in the manifest) as they complete.
+        Only dates whose games are all final are recorded, so live or upcoming games get picked up again later.
+        """
+        logging.info("STARTING CRAWL")
         game_dates = self.api.schedule(start_date, end_date)["dates"]
-        for date in game_dates:
-            game_date = datetime.strptime(date["date"], '%Y-%m-%d')
-            games_df = pd.DataFrame(pd.json_normalize(date.get("games")))
-            player_columns = ["player_person_id",
-                              "player_person_currentTeam_name",
-                              "player_person_fullName",
-                              "player_stats_skaterStats_assists",
-                              "player_stats_skaterStats_goals",
-                              "side"
-                              ]
-            player_stats_df = pd.DataFrame()
-            for idx, row in games_df.iterrows():
-                stats_dict = self.api.boxscore(row["gamePk"])
-                for team_side in ('home', 'away'):
-                    team_name = stats_dict["teams"][team_side]["team"]["name"]
-                    players = stats_dict["teams"][team_side]["players"].keys()
-                    for player in players:
-                        if stats_dict["teams"][team_side]["players"][f"{player}"]["stats"].get(
-                                "skaterStats") is not None:
-                            skater_stats = stats_dict["teams"][team_side]["players"][f"{player}"]["stats"][
-                                "skaterStats"]
-                            player_name = stats_dict["teams"][team_side]["players"][f"{player}"]["person"]["fullName"]
-                            goals, assists = [skater_stats[k] for k in ["goals", "assists"]]
-
-                            player_stats = pd.Series(
-                                [player.replace('ID', ''),
-                                 team_name,
-                                 player_name,
-                                 assists,
-                                 goals,
-                                 team_side
-                                 ],
-                                index=player_columns)
-                            player_stats_df = player_stats_df.append(player_stats, ignore_index=True)
-                s3_key = StorageKey(row["gamePk"], game_date)
-                self.storage.store_game(s3_key, player_stats_df[player_columns].to_csv(index=False))
-                logging.info(f"WRITING FILE: {s3_key.key()} to s3_data/{self.storage.bucket}/{s3_key.key()}")
-        logging.info(f"FILE WRITES COMPLETE")
+        pending = deque()
+        uploads = {}
+        skipped = written = 0
+        # boxscore calls are independent and IO bound, so fetch them concurrently.
+        # puts are small and dominated by per-request overhead, so keep many in flight at once
+        with ThreadPoolExecutor(max_workers=self.BOXSCORE_WORKERS) as fetch_executor, \
+                ThreadPoolExecutor(max_workers=self.UPLOAD_WORKERS) as upload_executor:
+            try:
+                for date in game_dates:
+                    # schedule dates are yyyy-mm-dd, keys want yyyymmdd
+                    game_date = date["date"].replace('-', '')
+                    games = date.get("games", [])
+                    game_ids = [game["gamePk"] for game in games]
+                    if self.manifest and self.manifest.is_written(game_date, game_ids):
+                        logging.info(f"SKIPPING {game_date}: ALREADY WRITTEN")
+                        skipped += 1
+                        continue
+                    final = all(game["status"]["abstractGameState"] == "Final" for game in games)
+                    fetches = [fetch_executor.submit(self.api.boxscore, game_id) for game_id in game_ids]
+                    pending.append((game_date, game_ids, final, fetches))
+                    if len(pending) >= self.DATES_IN_FLIGHT:
+                        self._submit_upload(upload_executor, uploads, *pending[0])
+                        pending.popleft()
+                    written += self._drain_uploads(uploads, self.UPLOAD_WORKERS)
+                while pending:
+                    self._submit_upload(upload_executor, uploads, *pending[0])
+                    pending.popleft()
+                    written += self._drain_uploads(uploads, self.UPLOAD_WORKERS)
+                written += self._drain_uploads(uploads, 0)
+            except BaseException:
+                # otherwise the executors' shutdown works through every queued fetch and upload before the
+                # error surfaces
+                for *_, fetches in pending:
+                    for fetch in fetches:
+                        fetch.cancel()
+                for upload in uploads:
+                    upload.cancel()
+                raise
+        logging.info(f"FILE WRITES COMPLETE: {written} WRITTEN, {skipped} SKIPPED")
+
+    def _submit_upload(self, upload_executor, uploads, game_date, game_ids, final, fetches) -> None:
+        """ waits on a date's boxscores, renders its csv and hands it to the upload executor """
+        boxscores = [fetch.result() for fetch in fetches]
+        s3_key = StorageKey(game_date)
+        upload = upload_executor.submit(self.storage.store_games, s3_key, self._render(game_ids, boxscores))
+        uploads[upload] = (game_date, game_ids, final, s3_key)
+
+    def _drain_uploads(self, uploads, max_in_flight) -> int:
+        """
+        records every finished upload, blocking until no more than max_in_flight are still running.
+        returns how many uploads finished
+        """
+        finished = 0
+        while uploads:
+            block = len(uploads) > max_in_flight
+            done, _ = wait(uploads, timeout=None if block else 0, return_when=FIRST_COMPLETED)
+            if not done:
+                break
+            for upload in done:
+                game_date, game_ids, final, s3_key = uploads.pop(upload)
+                upload.result()
+                finished += 1
+                logging.info(f"WROTE FILE: {s3_key.key()} to s3_data/{self.storage.bucket}/{s3_key.key()}")
+                if self.manifest and final:
+                    self.manifest.mark_written(game_date, game_ids)
+                elif self.manifest:
+                    logging.info(f"NOT RECORDING {game_date} IN MANIFEST: GAMES NOT FINAL")
+        return finished
+
+    def _render(self, game_ids, boxscores) -> str:
+        """ every game on a date goes into a single csv, game_id tells them apart """
+        rows = []
+        for game_id, stats_dict in zip(game_ids, boxscores):
+            for team_side in ('home', 'away'):
+                team = stats_dict["teams"][team_side]
+                team_name = team["team"]["name"]
+                players_dict = team["players"]
+                for player, p in players_dict.items():
+                    skater_stats = p["stats"].get("skaterStats")
+                    # goalies only carry goalieStats
+                    if skater_stats is None:
+                        continue
+                    # player keys look like "ID8475735"
+                    player_id = player[2:] if player.startswith('ID') else player.replace('ID', '')
+                    rows.append((player_id, team_name, p["person"]["fullName"],
+                                 skater_stats["assists"], skater_stats["goals"], team_side, game_id))
+        buf = io.StringIO()
+        writer = csv.writer(buf, lineterminator='\n')
+        writer.writerow(self.PLAYER_COLUMNS)
+        writer.writerows(rows)
+        return buf.getvalue()
 
 
 def main():
@@ -191,10 +308,15 @@ def main():
     start_date = dateparse(args['start_date'])
     end_date = dateparse(args['end_date'])
     api = NHLApi()
-    s3client = boto3.client('s3', config=Config(signature_version='s3v4'),
-                            endpoint_url=os.environ.get('S3_ENDPOINT_URL'))
+    # a single client is shared by every upload thread, so give each one a pooled connection
+    s3_config = Config(signature_version='s3v4',
+                       max_pool_connections=Crawler.UPLOAD_WORKERS,
+                       retries={'mode': 'adaptive', 'max_attempts': 10})
+    s3client = boto3.client('s3', config=s3_config, endpoint_url=os.environ.get('S3_ENDPOINT_URL'))
     storage = Storage(dest_bucket, s3client)
-    crawler = Crawler(api, storage)
+    manifest_path = os.environ.get('MANIFEST_PATH')
+    manifest = Manifest(manifest_path, dest_bucket) if manifest_path else None
+    crawler = Crawler(api, storage, manifest)
     crawler.crawl(start_date, end_date)
 
 
@@ -1,5 +1,258 @@
+import gzip
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
 import pytest
+import requests
+from urllib3.util.retry import Retry
+
+from nhldata.app import Crawler, Manifest, NHLApi, Storage, StorageKey
+
+RESOURCES = os.path.join(os.path.dirname(__file__), 'resources')
+
+
+@pytest.fixture
+def boxscore():
+    with open(os.path.join(RESOURCES, 'boxscore.json')) as f:
+        return json.load(f)
+
+
+def game(game_id, state="Final"):
+    return {"gamePk": game_id, "status": {"abstractGameState": state}}
+
+
+class FakeApi:
+    def __init__(self, schedule, boxscores):
+        self._schedule = schedule
+        self._boxscores = boxscores
+        self.fetched = []
+
+    def schedule(self, start_date, end_date):
+        return self._schedule
+
+    def boxscore(self, game_id):
+        self.fetched.append(game_id)
+        return self._boxscores[game_id]
+
+
+class FakeStorage:
+    bucket = 'test-bucket'
+
+    def __init__(self):
+        self.games = {}
+
+    def store_games(self, key: StorageKey, games_data) -> bool:
+        self.games[key.key()] = games_data
+        return True
+
+
+def test_crawl_writes_skater_stats(boxscore):
+    api = FakeApi({"dates": [{"date": "2020-08-04", "games": [game(2019030016)]}]},
+                  {2019030016: boxscore})
+    storage = FakeStorage()
+    Crawler(api, storage).crawl(datetime(2020, 8, 4), datetime(2020, 8, 4))
+
+    lines = storage.games['20200804/games.csv.gz'].splitlines()
+    assert lines[0] == ("player_person_id,player_person_currentTeam_name,player_person_fullName,"
+                        "player_stats_skaterStats_assists,player_stats_skaterStats_goals,side,game_id")
+    # 18 skaters per side, goalies are skipped
+    assert len(lines) == 1 + 36
+    assert lines[1].startswith('8475735,New York Rangers,')
+    assert lines[1].endswith(',home,2019030016')
+
+
+def test_crawl_writes_one_file_per_date(boxscore):
+    api = FakeApi({"dates": [{"date": "2020-08-04", "games": [game(1), game(2)]},
+                             {"date": "2020-08-05", "games": [game(3)]}]},
+                  {1: boxscore, 2: boxscore, 3: boxscore})
+    storage = FakeStorage()
+    Crawler(api, storage).crawl(datetime(2020, 8, 4), datetime(2020, 8, 5))
+
+    assert sorted(storage.games) == ['20200804/games.csv.gz', '20200805/games.csv.gz']
+    game_ids = [line.rsplit(',', 1)[1] for line in storage.games['20200804/games.csv.gz'].splitlines()[1:]]
+    assert game_ids == ['1'] * 36 + ['2'] * 36
+    assert len(storage.games['20200805/games.csv.gz'].splitlines()) == 1 + 36
+
+
+def test_crawl_pipelines_more_dates_than_in_flight(boxscore):
+    dates = [{"date": f"2020-08-{day:02d}", "games": [game(day)]} for day in range(1, Crawler.DATES_IN_FLIGHT + 3)]
+    api = FakeApi({"dates": dates}, {date["games"][0]["gamePk"]: boxscore for date in dates})
+    storage = FakeStorage()
+    Crawler(api, storage).crawl(datetime(2020, 8, 1), datetime(2020, 8, 31))
+
+    assert sorted(storage.games) == [f"202008{day:02d}/games.csv.gz" for day in range(1, Crawler.DATES_IN_FLIGHT + 3)]
+
+
+class FailingApi(FakeApi):
+    def __init__(self, schedule, boxscores, failing_game_id, slow_game_id=None):
+        super().__init__(schedule, boxscores)
+        self._failing_game_id = failing_game_id
+        self._slow_game_id = slow_game_id
+
+    def boxscore(self, game_id):
+        if game_id == self._failing_game_id:
+            raise requests.exceptions.HTTPError('500 Server Error')
+        if game_id == self._slow_game_id:
+            time.sleep(0.2)
+        return super().boxscore(game_id)
+
+
+class FailingStorage(FakeStorage):
+    def store_games(self, key: StorageKey, games_data) -> bool:
+        raise requests.exceptions.ConnectionError('s3 unavailable')
+
+
+def one_game_per_day(days):
+    return {"dates": [{"date": f"2020-08-{day:02d}", "games": [game(day)]} for day in days]}
+
+
+def test_crawl_propagates_failed_fetch_and_cancels_queued_ones(boxscore, monkeypatch):
+    # a single fetch worker keeps the other dates' fetches queued behind the failing one
+    monkeypatch.setattr(Crawler, 'BOXSCORE_WORKERS', 1)
+    days = range(1, Crawler.DATES_IN_FLIGHT + 2)
+    api = FailingApi(one_game_per_day(days), {day: boxscore for day in days}, failing_game_id=1, slow_game_id=2)
+    storage = FakeStorage()
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        Crawler(api, storage).crawl(datetime(2020, 8, 1), datetime(2020, 8, 31))
+    assert set(api.fetched) <= {2}
+    assert storage.games == {}
+
+
+def test_crawl_propagates_failed_upload(boxscore):
+    api = FakeApi(one_game_per_day([1, 2]), {1: boxscore, 2: boxscore})
+
+    with pytest.raises(requests.exceptions.ConnectionError):
+        Crawler(api, FailingStorage()).crawl(datetime(2020, 8, 1), datetime(2020, 8, 2))
+
+
+def test_crawl_skips_dates_in_manifest(boxscore, tmp_path):
+    manifest_path = str(tmp_path / 'manifest.json')
+    schedule = {"dates": [{"date": "2020-08-04", "games": [game(1)]},
+                          {"date": "2020-08-05", "games": [game(2)]}]}
+    api = FakeApi(schedule, {1: boxscore, 2: boxscore, 3: boxscore})
+    Crawler(api, FakeStorage(), Manifest(manifest_path, 'test-bucket')).crawl(datetime(2020, 8, 4), datetime(2020, 8, 5))
+    assert sorted(api.fetched) == [1, 2]
+
+    # a game added to an already written date forces that date to be rewritten
+    schedule["dates"][1]["games"].append(game(3))
+    api.fetched = []
+    storage = FakeStorage()
+    Crawler(api, storage, Manifest(manifest_path, 'test-bucket')).crawl(datetime(2020, 8, 4), datetime(2020, 8, 5))
+    assert sorted(api.fetched) == [2, 3]
+    assert sorted(storage.games) == ['20200805/games.csv.gz']
+
+
+def test_crawl_does_not_record_dates_with_unfinished_games(boxscore, tmp_path):
+    manifest_path = str(tmp_path / 'manifest.json')
+    schedule = {"dates": [{"date": "2020-08-04", "games": [game(1), game(2, state="Live")]}]}
+    api = FakeApi(schedule, {1: boxscore, 2: boxscore})
+    Crawler(api, FakeStorage(), Manifest(manifest_path, 'test-bucket')).crawl(datetime(2020, 8, 4), datetime(2020, 8, 4))
+
+    api.fetched = []
+    Crawler(api, FakeStorage(), Manifest(manifest_path, 'test-bucket')).crawl(datetime(2020, 8, 4), datetime(2020, 8, 4))
+    assert sorted(api.fetched) == [1, 2]
+
+
+def test_manifest_is_kept_per_bucket(boxscore, tmp_path):
+    manifest_path = str(tmp_path / 'manifest.json')
+    api = FakeApi({"dates": [{"date": "2020-08-04", "games": [game(1)]}]}, {1: boxscore})
+    Crawler(api, FakeStorage(), Manifest(manifest_path, 'test-bucket')).crawl(datetime(2020, 8, 4), datetime(2020, 8, 4))
+
+    storage = FakeStorage()
+    Crawler(api, storage, Manifest(manifest_path, 'other-bucket')).crawl(datetime(2020, 8, 4), datetime(2020, 8, 4))
+    assert sorted(storage.games) == ['20200804/games.csv.gz']
+    assert Manifest(manifest_path, 'test-bucket').is_written('20200804', [1])
+
+
+class FakeS3Client:
+    def __init__(self):
+        self.puts = []
+
+    def put_object(self, **kwargs):
+        self.puts.append(kwargs)
+
+
+def test_store_games_gzips_body():
+    s3_client = FakeS3Client()
+    Storage('test-bucket', s3_client).store_games(StorageKey('20200804'), 'a,b\n1,2\n')
+
+    put, = s3_client.puts
+    assert put['Key'] == '20200804/games.csv.gz'
+    assert put['ContentType'] == 'application/gzip'
+    assert 'ContentEncoding' not in put
+    assert gzip.decompress(put['Body']) == b'a,b\n1,2\n'
+
+
+class FakeResponse:
+    def __init__(self, status_code, content=b'{}'):
+        self.status_code = status_code
+        self.content = content
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.exceptions.HTTPError(f'{self.status_code} Error')
+
+
+class FakeSession:
+    def __init__(self, response):
+        self.response = response
+        self.calls = []
+
+    def get(self, url, **kwargs):
+        self.calls.append((url, kwargs))
+        return self.response
+
+
+def test_get_passes_timeout_and_decodes():
+    api = NHLApi(base='https://example.test')
+    api._session = FakeSession(FakeResponse(200, b'{"dates": []}'))
+
+    assert api.schedule(datetime(2020, 8, 4), datetime(2020, 8, 5)) == {"dates": []}
+    (url, kwargs), = api._session.calls
+    assert url == 'https://example.test/schedule'
+    assert kwargs['timeout'] == NHLApi.TIMEOUT
+    assert kwargs['params'] == {'startDate': '2020-08-04', 'endDate': '2020-08-05'}
+
+
+def test_get_reraises_http_errors():
+    api = NHLApi(base='https://example.test')
+    api._session = FakeSession(FakeResponse(404))
+
+    with pytest.raises(requests.exceptions.HTTPError):
+        api.boxscore(1)
+
+
+@pytest.fixture
+def unavailable_server():
+    class Handler(BaseHTTPRequestHandler):
+        requests_seen = 0
+
+        def do_GET(self):
+            Handler.requests_seen += 1
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    server = HTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{server.server_port}', Handler
+    server.shutdown()
+    server.server_close()
+
+
+def test_get_raises_retry_error_when_retries_exhausted(unavailable_server, monkeypatch):
+    base, handler = unavailable_server
+    monkeypatch.setattr(NHLApi, 'RETRIES', Retry(total=2, backoff_factor=0, status_forcelist=[503]))
 
-# TODO feel free to add tests for anything as you work things out
-def test_app():
-    pass
+    with pytest.raises(requests.exceptions.RetryError):
+        NHLApi(base=base).boxscore(1)
+    assert handler.requests_seen == 3